@@ -2,14 +2,47 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import pytest
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import boto3
-import requests
+import httpx
+import orjson
+import certifi
 import logging
 import re
 import os
+import ssl
+
+from dataclasses import dataclass
+from typing import Optional
+from urllib.parse import urlencode
 
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from filelock import FileLock
 from requests_aws4auth import AWS4Auth
 
+logger = logging.getLogger(__name__)
+
+# Parsing the CA bundle is surprisingly expensive; build one SSL context at
+# import and share it across every client created by this module.
+_SSL_CONTEXT = ssl.create_default_context(cafile=certifi.where())
+
+
+# Environment settings for the suite. A frozen dataclass rather than a dict,
+# so consumers read attributes instead of hashing key strings on every use.
+
+@dataclass(frozen=True, slots=True)
+class TestEnv:
+    media_path: str
+    sample_image: str
+    region: str
+    mi_stack_name: str
+    access_key: str
+    secret_key: str
+    session_token: Optional[str] = None
+
 
 # Fixture for retrieving env variables
 
@@ -17,179 +50,250 @@ from requests_aws4auth import AWS4Auth
 def testing_env_variables():
     print('Setting variables for tests')
     try:
-        test_env_vars = {
-            'MEDIA_PATH': os.environ['TEST_MEDIA_PATH'],
-            'SAMPLE_IMAGE': os.environ['SAMPLE_IMAGE'],
-            'REGION': os.environ['REGION'],
-            'MI_STACK_NAME': os.environ['MI_STACK_NAME'],
-            'ACCESS_KEY': os.environ['AWS_ACCESS_KEY_ID'],
-            'SECRET_KEY': os.environ['AWS_SECRET_ACCESS_KEY']
-        }
-
-        # Optional session token may be set if we are using temporary STS credentials.
-        session_token = os.environ.get('AWS_SESSION_TOKEN', '')
-        if len(session_token):
-            test_env_vars['SESSION_TOKEN'] = session_token
+        env = TestEnv(
+            media_path=os.environ['TEST_MEDIA_PATH'],
+            sample_image=os.environ['SAMPLE_IMAGE'],
+            region=os.environ['REGION'],
+            mi_stack_name=os.environ['MI_STACK_NAME'],
+            access_key=os.environ['AWS_ACCESS_KEY_ID'],
+            secret_key=os.environ['AWS_SECRET_ACCESS_KEY'],
+            # Optional session token may be set if we are using temporary STS credentials.
+            session_token=os.environ.get('AWS_SESSION_TOKEN') or None)
 
     except KeyError as e:
         logging.error("ERROR: Missing a required environment variable for testing: {variable}".format(variable=e))
         raise Exception(e)
     else:
-        return test_env_vars
+        return env
+
+
+# API endpoint patterns are compiled once per region. The [^/.]+ host label
+# class cannot backtrack the way a leading '.*' does.
+
+_REGEX_CACHE = {}
+
+
+def _api_endpoint_regex(region):
+    return _REGEX_CACHE.setdefault(
+        region,
+        re.compile(r'[^/.]+\.execute-api\.' + re.escape(region) + r'\.amazonaws\.com/api/'))
+
+
+# Fixture for the shared boto3 session. Creating a session loads endpoint
+# data and resolves credentials; session scope pays that cost once and lets
+# every AWS client here derive from it.
+
+@pytest.fixture(scope='session')
+def aws_session(testing_env_variables):
+    return boto3.Session(
+        aws_access_key_id=testing_env_variables.access_key,
+        aws_secret_access_key=testing_env_variables.secret_key,
+        aws_session_token=testing_env_variables.session_token,
+        region_name=testing_env_variables.region)
+
+
+def _outputs(cfn, name):
+    return {output["OutputKey"]: output["OutputValue"]
+            for output in cfn.describe_stacks(StackName=name)['Stacks'][0]['Outputs']}
 
 
 # Fixture for stack resources
 
 @pytest.fixture(scope='session')
-def stack_resources(testing_env_variables):
+def stack_resources(testing_env_variables, aws_session):
     print('Validating Stack Resources')
     resources = {}
     # is the dataplane api and bucket present?
 
-    client = boto3.client('cloudformation', region_name=testing_env_variables['REGION'])
-    response = client.describe_stacks(StackName=testing_env_variables['MI_STACK_NAME'])
-    outputs = response['Stacks'][0]['Outputs']
-
-    for output in outputs:
-        resources[output["OutputKey"]] = output["OutputValue"]
+    client = aws_session.client('cloudformation')
+    resources.update(_outputs(client, testing_env_variables.mi_stack_name))
 
     assert "DataplaneApiEndpoint" in resources
     assert "DataplaneBucket" in resources
 
-    api_endpoint_regex = ".*.execute-api."+testing_env_variables['REGION']+".amazonaws.com/api/.*"
+    assert _api_endpoint_regex(testing_env_variables.region).search(resources["DataplaneApiEndpoint"])
 
-    assert re.match(api_endpoint_regex, resources["DataplaneApiEndpoint"])
+    if "TestStack" in resources:
+        resources.update(_outputs(client, resources["TestStack"]))
 
-    response = client.describe_stacks(StackName=resources["TestStack"])
+    return resources
 
-    outputs = response['Stacks'][0]['Outputs']
-    for output in outputs:
-        resources[output["OutputKey"]] = output["OutputValue"]
 
-    return resources
+# Fixture for the SigV4 request signer. Session scoped so the HMAC signing
+# key chain is derived once and shared by every API object. include_hdrs
+# keeps x-amz-* so the STS security token header stays signed.
+
+@pytest.fixture(scope='session')
+def signer(testing_env_variables):
+    return AWS4Auth(testing_env_variables.access_key, testing_env_variables.secret_key,
+                    testing_env_variables.region, 'execute-api',
+                    session_token=testing_env_variables.session_token,
+                    include_hdrs=('host', 'content-type', 'x-amz-*'))
 
 
-# This fixture uploads the sample media objects for testing.
-@pytest.fixture(scope='session', autouse=True)
-def upload_media(testing_env_variables, stack_resources):
+# This fixture uploads the sample media objects for testing. Suites that don't
+# need media should not request it (gate tests with pytest.mark.usefixtures).
+@pytest.fixture(scope='session')
+def upload_media(testing_env_variables, stack_resources, aws_session, tmp_path_factory):
     print('Uploading Test Media')
-    s3 = boto3.client('s3', region_name=testing_env_variables['REGION'])
-    # Upload test media files
-    s3.upload_file(testing_env_variables['MEDIA_PATH'] + testing_env_variables['SAMPLE_IMAGE'], stack_resources['DataplaneBucket'], 'upload/' + testing_env_variables['SAMPLE_IMAGE'])
+    s3 = aws_session.client('s3', config=Config(max_pool_connections=25, tcp_keepalive=True))
+    media_file = testing_env_variables.media_path + testing_env_variables.sample_image
+    media_key = 'upload/' + testing_env_variables.sample_image
+    # Session fixtures run once per pytest-xdist worker. The lock serializes
+    # the check-then-upload so the first worker does the PUT and the rest see
+    # the object via head_object and skip. The lock file lives in the temp
+    # directory shared by all workers of the run.
+    lock_file = tmp_path_factory.getbasetemp().parent / 'media-upload.lock'
+    with FileLock(str(lock_file)):
+        # Skip the upload if an identically sized copy is already in the
+        # bucket from a previous test session (or another worker).
+        try:
+            head = s3.head_object(Bucket=stack_resources['DataplaneBucket'], Key=media_key)
+        except ClientError:
+            head = None
+        if head is None or head['ContentLength'] != os.path.getsize(media_file):
+            # Upload test media files. The sample image goes up in one PUT,
+            # but larger sample media benefits from parallel multipart parts.
+            transfer_config = TransferConfig(multipart_threshold=8 * 1024 * 1024,
+                                             multipart_chunksize=8 * 1024 * 1024,
+                                             max_concurrency=10,
+                                             use_threads=True)
+            s3.upload_file(media_file, stack_resources['DataplaneBucket'], media_key, Config=transfer_config)
     # Wait for fixture to go out of scope:
     yield upload_media
 
 
-@pytest.mark.usefixtures("upload_media")
 class API:
-    def __init__(self, stack_resources, testing_env_variables):
+    def __init__(self, stack_resources, testing_env_variables, signer):
         self.env_vars = testing_env_variables
         self.stack_resources = stack_resources
-        self.auth = AWS4Auth(testing_env_variables['ACCESS_KEY'], testing_env_variables['SECRET_KEY'],
-                             testing_env_variables['REGION'], 'execute-api',
-                             session_token=testing_env_variables.get('SESSION_TOKEN'))
-
-        # aws_access_key = testing_env_variables['ACCESS_KEY'],
-        # aws_secret_access_key = testing_env_variables['SECRET_KEY'],
-        # aws_host = stack_resources['DataplaneApiEndpoint'].split('/')[0],
-        # aws_region = testing_env_variables['REGION'],
-        # aws_service = 'execute-api'
+        self.auth = signer
+        # Normalized once so route paths below never produce '//' regardless
+        # of whether the stack output carries a trailing slash.
+        self._base = stack_resources["DataplaneApiEndpoint"].rstrip('/') + '/'
+
+        # One HTTP/2 client per API instance: concurrent calls multiplex
+        # streams over a single TLS session instead of opening a socket per
+        # request. Only connect failures are retried; statuses such as the
+        # 500 from a double checkout are surfaced because tests assert on
+        # them.
+        self.client = httpx.Client(
+            auth=self.auth,
+            headers={"Content-Type": "application/json"},
+            timeout=60.0,
+            transport=httpx.HTTPTransport(
+                http2=True,
+                retries=3,
+                verify=_SSL_CONTEXT,
+                limits=httpx.Limits(max_connections=20, max_keepalive_connections=20)))
 
     # dataplane methods
 
     def create_asset(self):
-        headers = {"Content-Type": "application/json"}
         body = {
             "Input": {
                 "MediaType": "Image",
                 "S3Bucket": self.stack_resources['DataplaneBucket'],
-                "S3Key": "upload/" + self.env_vars['SAMPLE_IMAGE']
+                "S3Key": "upload/" + self.env_vars.sample_image
             }
         }
 
-        print("POST /create")
-        create_asset_response = requests.post(self.stack_resources["DataplaneApiEndpoint"] + '/create', headers=headers, json=body, verify=True, auth=self.auth, timeout=60)
+        logger.debug("POST /create")
+        create_asset_response = self.client.post(f"{self._base}create", json=body)
         return create_asset_response
 
     def post_metadata(self, asset_id, metadata, paginate=False, end=False):
-        if paginate is True and end is True:
-            url = self.stack_resources["DataplaneApiEndpoint"] + 'metadata/' + asset_id + "?paginated=true&end=true"
-        elif paginate is True and end is False:
-            url = self.stack_resources["DataplaneApiEndpoint"] + 'metadata/' + asset_id + "?paginated=true"
-        else:
-            url = self.stack_resources["DataplaneApiEndpoint"] + 'metadata/' + asset_id
-
-        headers = {"Content-Type": "application/json"}
-        body = metadata
-        print("POST /metadata/{asset}".format(asset=asset_id))
-        nonpaginated_metadata_response = requests.post(url, headers=headers, json=body, verify=True, auth=self.auth, timeout=60)
+        query = {}
+        if paginate is True:
+            query['paginated'] = 'true'
+            if end is True:
+                query['end'] = 'true'
+
+        url = f"{self._base}metadata/{asset_id}"
+        if query:
+            url = f"{url}?{urlencode(query)}"
+
+        # Metadata payloads (label/face/celebrity lists) can get large;
+        # orjson serializes them straight to bytes, well ahead of the stdlib
+        # json encoding that requests would do for a json= body.
+        payload = orjson.dumps(metadata)
+        logger.debug("POST /metadata/%s", asset_id)
+        nonpaginated_metadata_response = self.client.post(url, content=payload)
         return nonpaginated_metadata_response
 
+    def post_metadata_many(self, asset_id, items, max_workers=8):
+        # Posts independent (nonpaginated) metadata items concurrently. Keep
+        # max_workers at or below the client's max_connections so the threads
+        # never block waiting on a free stream. Responses are returned in
+        # completion order, not submission order.
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(self.post_metadata, asset_id, metadata) for metadata in items]
+            return [future.result() for future in as_completed(futures)]
+
     def checkout_asset(self, asset_id):
-        headers = {"Content-Type": "application/json"}
         body = {"LockedBy": "user01@example.com"}
-        print("POST /checkout/{asset}".format(asset=asset_id))
-        response = requests.post(self.stack_resources["DataplaneApiEndpoint"] + '/checkout/' + asset_id, headers=headers, json=body, verify=True, auth=self.auth, timeout=60)
+        logger.debug("POST /checkout/%s", asset_id)
+        response = self.client.post(f"{self._base}checkout/{asset_id}", json=body)
         return response
 
     def list_checkouts(self):
-        headers = {"Content-Type": "application/json"}
-        print("GET /checkouts")
-        response = requests.get(self.stack_resources["DataplaneApiEndpoint"] + '/checkouts', headers=headers, verify=True, auth=self.auth, timeout=60)
+        logger.debug("GET /checkouts")
+        response = self.client.get(f"{self._base}checkouts")
         return response
 
     def checkin_asset(self, asset_id):
-        headers = {"Content-Type": "application/json"}
-        print("POST /checkout/{asset}".format(asset=asset_id))
-        response = requests.post(self.stack_resources["DataplaneApiEndpoint"] + '/checkin/' + asset_id, headers=headers, verify=True, auth=self.auth, timeout=60)
+        logger.debug("POST /checkin/%s", asset_id)
+        response = self.client.post(f"{self._base}checkin/{asset_id}")
         return response
 
     def get_all_metadata(self, asset_id, cursor=None):
 
-        url = self.stack_resources["DataplaneApiEndpoint"] + 'metadata/' + asset_id
-        headers = {"Content-Type": "application/json"}
-        print("GET /metadata/{asset}".format(asset=asset_id))
-
+        url = f"{self._base}metadata/{asset_id}"
         if cursor is None:
-            print("GET /metadata/{asset}".format(asset=asset_id))
-            metadata_response = requests.get(url, headers=headers, verify=True, auth=self.auth, timeout=60)
+            logger.debug("GET /metadata/%s", asset_id)
+            metadata_response = self.client.get(url)
         else:
-            print("GET /metadata/{asset}?cursor={cursor}".format(asset=asset_id, cursor=cursor))
+            logger.debug("GET /metadata/%s?cursor=%s", asset_id, cursor)
             query_params = {"cursor": cursor}
-            metadata_response = requests.get(url, headers=headers, params=query_params, verify=True, auth=self.auth, timeout=60)
+            metadata_response = self.client.get(url, params=query_params)
 
-        print(metadata_response.json())
-        print(metadata_response.text)
+        if logger.isEnabledFor(logging.DEBUG):
+            # .text already carries the JSON payload; decode it only when
+            # someone is listening.
+            logger.debug("resp=%s", metadata_response.text)
         return metadata_response
 
     def get_single_metadata_field(self, asset_id, operator):
         metadata_field = operator["OperatorName"]
-        url = self.stack_resources["DataplaneApiEndpoint"] + 'metadata/' + asset_id + "/" + metadata_field
-        headers = {"Content-Type": "application/json"}
-        print("GET /metadata/{asset}/{operator}".format(asset=asset_id, operator=operator["OperatorName"]))
-        single_metadata_response = requests.get(url, headers=headers, verify=True, auth=self.auth, timeout=60)
+        url = f"{self._base}metadata/{asset_id}/{metadata_field}"
+        logger.debug("GET /metadata/%s/%s", asset_id, metadata_field)
+        single_metadata_response = self.client.get(url)
         return single_metadata_response
 
     def delete_single_metadata_field(self, asset_id, operator):
         metadata_field = operator["OperatorName"]
-        url = self.stack_resources["DataplaneApiEndpoint"] + 'metadata/' + asset_id + "/" + metadata_field
-        headers = {"Content-Type": "application/json"}
-        print("DELETE /metadata/{asset}/{operator}".format(asset=asset_id, operator=operator["OperatorName"]))
-        delete_single_metadata_response = requests.delete(url, headers=headers, verify=True, auth=self.auth, timeout=60)
+        url = f"{self._base}metadata/{asset_id}/{metadata_field}"
+        logger.debug("DELETE /metadata/%s/%s", asset_id, metadata_field)
+        delete_single_metadata_response = self.client.delete(url)
         return delete_single_metadata_response
 
     def delete_asset(self, asset_id):
-        url = self.stack_resources["DataplaneApiEndpoint"] + 'metadata/' + asset_id
-        headers = {"Content-Type": "application/json"}
-        print("DELETE /metadata/{asset}".format(asset=asset_id))
-        delete_asset_response = requests.delete(url, headers=headers, verify=True, auth=self.auth, timeout=60)
+        url = f"{self._base}metadata/{asset_id}"
+        logger.debug("DELETE /metadata/%s", asset_id)
+        delete_asset_response = self.client.delete(url)
         return delete_asset_response
 
 
 @pytest.fixture(scope='session')
-def dataplane_api(stack_resources, testing_env_variables):
+def dataplane_api(stack_resources, testing_env_variables, signer):
+    print('Generating a dataplane API object for testing')
+    testing_api = API(stack_resources, testing_env_variables, signer)
+
+    # Kept as a factory for existing call sites, but every call now returns
+    # the same API object (and its pooled session).
     def _gen_api():
-        print('Generating a dataplane API object for testing')
-        testing_api = API(stack_resources, testing_env_variables)
         return testing_api
-    return _gen_api
+
+    yield _gen_api
+    # Release the pooled connections held by the shared API object.
+    testing_api.client.close()
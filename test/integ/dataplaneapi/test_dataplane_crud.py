@@ -15,6 +15,7 @@
 #
 ###############################################################################
 
+import pytest
 import urllib3
 
 # Testing data
@@ -48,6 +49,7 @@ session_paginated_results = {
 # TODO: Add assert statements for status == success in api response json
 
 
+@pytest.mark.usefixtures("upload_media")
 def test_dataplane_api(dataplane_api):
     api = dataplane_api()
     urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
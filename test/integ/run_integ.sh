@@ -82,7 +82,8 @@ if [ "$1" = "" ]; then
     fi
 elif [ "$1" = "dataplaneapi" ]; then
     echo "Running dataplane integ tests"
-    pytest dataplaneapi/ -s -W ignore::DeprecationWarning -p no:cacheprovider
+    # loadfile keeps the state-dependent checkout/checkin flow on one worker
+    pytest dataplaneapi/ -s -W ignore::DeprecationWarning -p no:cacheprovider -n auto --dist loadfile
     if [ $? -eq 0 ]; then
 	exit 0
     else